@@ -1,10 +1,65 @@
 import asyncio
-import json
-from typing import Dict, List
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Dict, List, Optional, Set, Tuple
 from astrbot.api.star import Context, Star, register
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api import AstrBotConfig, logger
-from astrbot.core.utils.session_waiter import session_waiter, SessionController
+
+try:
+    # Python 3.11+ 自带可重设截止时间的 timeout
+    from asyncio import timeout as _debounce_timeout
+except ImportError:
+    # Python 3.10 使用 aiohttp 依赖的 async-timeout
+    from async_timeout import timeout as _debounce_timeout
+
+try:
+    # orjson 解析更快，未安装时回退到标准库
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+try:
+    import astrbot.api.message_components as Comp
+except ImportError:
+    Comp = None
+
+# 文本 / 图片组件类型，导入时解析一次
+# 文本组件都是具体类，循环中用 type(c) in set 精确匹配，省去 isinstance 的继承链遍历
+_TEXT_TYPES = frozenset(t for t in (getattr(Comp, 'Plain', None), getattr(Comp, 'Text', None)) if t)
+# 图片可能由不同的组件类（或其子类）承载，预先组成元组供一次 isinstance 调用匹配
+_IMAGE_TYPES = tuple(t for t in (getattr(Comp, 'Image', None), getattr(Comp, 'Picture', None)) if t)
+
+# 返回给用户的固定提示
+_MSG_EMPTY_RESP = "抱歉，AI 没有返回有效响应。"
+_MSG_INTERNAL_ERR = "插件内部错误: "
+
+# LLM 响应中可能携带文本的属性，按优先级排列
+_RESP_ATTRS = ('completion_text', 'result', 'content', 'text', 'message')
+
+
+class _DebounceWindow:
+    """一轮防抖窗口的状态：所属会话、消息队列、消息缓冲区与图片 URL"""
+    
+    __slots__ = ('umo', 'queue', 'buffer', 'image_urls', 'seen_urls', 'done', 'earlier', 'count', 'chars')
+    
+    def __init__(self):
+        self.umo: str = ""
+        # 窗口的消息提交完毕（包括登记历史写回）时完成，每次取出窗口时重新创建
+        self.done: Optional[asyncio.Future] = None
+        # 开启窗口时同一会话中尚未提交完毕的更早窗口的 done，本窗口读取历史前要等它们
+        self.earlier: Tuple[asyncio.Future, ...] = ()
+        # 同一会话的后续消息由各自的事件处理器放入队列；None 表示收到指令，提前结束
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.buffer: List[str] = []
+        self.image_urls: List[str] = []
+        self.seen_urls: Set[str] = set()
+        # 已接收（缓冲区中和队列中）的消息条数与字符数，入队时累加，用于判断窗口是否已满
+        self.count = 0
+        self.chars = 0
 
 
 @register(
@@ -28,13 +83,51 @@ class ContinuousMessagePlugin(Star):
     - 强制仅在私聊启用，避免群聊中不同用户的消息被误合并
     """
     
-    # 尝试导入 Image 组件类（用于类型检查）
-    _ImageComponent = None
-    try:
-        from astrbot.api.message import Image as _ImageComponent
-    except ImportError:
-        # 如果导入失败，使用类名检查作为后备方案
-        pass
+    # 插件自身的属性使用 slot 存储（Star 基类没有 __slots__，实例仍保留 __dict__ 供框架使用）
+    __slots__ = (
+        'config',
+        'debounce_time',
+        'command_prefixes',
+        'enable_plugin',
+        'merge_separator',
+        'max_history_turns',
+        'history_cache_buffer',
+        'max_buffer_messages',
+        'max_buffer_chars',
+        '_command_prefixes_tuple',
+        '_persona_manager',
+        '_conv_mgr',
+        '_active_windows',
+        '_unfinished_windows',
+        '_inflight_requests',
+        '_history_locks',
+        '_persona_cache',
+        '_response_attr_by_type',
+        '_window_pool',
+        '_provider_cache',
+        '_pending_writes',
+    )
+    
+    # 会话人格（系统提示词）的缓存上限（会话数），以及有效期（秒）
+    _PERSONA_CACHE_SIZE = 256
+    _PERSONA_CACHE_TTL = 60
+    
+    # 防抖窗口复用池的容量
+    _WINDOW_POOL_SIZE = 32
+    
+    # 单轮合并最多传给 LLM 的图片数
+    _MAX_IMAGES = 16
+    
+    # 会话所用 LLM 提供商的缓存上限（会话数），以及有效期（秒）
+    _PROVIDER_CACHE_SIZE = 256
+    _PROVIDER_CACHE_TTL = 30
+    
+    # 单次历史写回的超时，以及插件卸载时等待写回完成的最长时间（秒）
+    _HISTORY_WRITE_TIMEOUT = 10
+    _TERMINATE_TIMEOUT = 5
+    
+    # 指令等待同一会话的防抖窗口提交、历史写回完成的最长时间（秒）
+    _COMMAND_WAIT_TIMEOUT = 60
     
     def __init__(self, context: Context, config: AstrBotConfig = None):
         super().__init__(context)
@@ -45,9 +138,56 @@ class ContinuousMessagePlugin(Star):
         self.command_prefixes = self.config.get('command_prefixes', ['/'])
         self.enable_plugin = self.config.get('enable', True)
         self.merge_separator = self.config.get('merge_separator', '\n')
+        self.max_history_turns = int(self.config.get('max_history_turns', 12))
+        self.history_cache_buffer = max(1, int(self.config.get('history_cache_buffer', 4)))
+        # 单个防抖窗口最多缓冲的消息条数 / 字符数，设置为 0（或负数）表示不限制
+        self.max_buffer_messages = max(0, int(self.config.get('max_buffer_messages', 64))) or float('inf')
+        self.max_buffer_chars = max(0, int(self.config.get('max_buffer_chars', 8192))) or float('inf')
+        
+        # str.startswith 可直接接受元组，一次调用检查所有前缀
+        # 配置成单个字符串时视为一个前缀；空前缀会让所有消息都被当成指令，予以忽略
+        prefixes = self.command_prefixes
+        if isinstance(prefixes, str):
+            prefixes = [prefixes]
+        self._command_prefixes_tuple = tuple(p for p in prefixes if isinstance(p, str) and p)
+        
+        # 预先绑定常用的管理器，避免每次调用 LLM 时重复解析属性链
+        # （部分版本可能延迟初始化，取不到时在使用处回退到 self.context）
+        self._persona_manager = getattr(context, 'persona_manager', None)
+        self._conv_mgr = getattr(context, 'conversation_manager', None)
+        
+        # 进行中的防抖窗口：unified_msg_origin -> 该会话的窗口
+        self._active_windows: Dict[str, _DebounceWindow] = {}
+        # 尚未提交完毕（收集中或正在请求 LLM）的窗口：unified_msg_origin -> {窗口的 done}
+        self._unfinished_windows: Dict[str, Set[asyncio.Future]] = {}
+        
+        # 进行中的 LLM 请求：请求摘要（见 _request_key）-> 回复的 Future
+        # 相同的请求（用户在收到回复前重发）等待它，而不是再请求一次 LLM；请求结束后移除
+        self._inflight_requests: Dict[bytes, asyncio.Future] = {}
+        
+        # 每个会话一把写回锁：unified_msg_origin -> [锁, 使用中的写回数]
+        # 同一会话的写回按顺序执行（后写入的历史不会被先前较短的历史覆盖），不同会话互不阻塞
+        self._history_locks: Dict[str, list] = {}
+        
+        # 会话人格缓存：unified_msg_origin -> (时间戳, 系统提示词)
+        # 收到指令（可能是切换人格）时失效
+        self._persona_cache: "OrderedDict[str, Tuple[float, Optional[str]]]" = OrderedDict()
+        
+        # 各类 LLM 响应对象上实际携带文本的属性名：响应类型 -> 属性名
+        self._response_attr_by_type: Dict[type, str] = {}
+        
+        # 防抖窗口复用池，窗口结束后清空放回
+        self._window_pool: List[_DebounceWindow] = []
+        
+        # LLM 提供商缓存：unified_msg_origin -> (时间戳, 提供商)，按写入时间排列
+        # 收到指令（可能是切换提供商）时失效
+        self._provider_cache: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        
+        # 后台写回对话历史的任务：unified_msg_origin -> {任务}（保留引用，避免任务在完成前被回收）
+        self._pending_writes: Dict[str, Set[asyncio.Task]] = {}
         
         # 输出到 logger
-        logger.info(f"[消息防抖动] 插件已加载 - 启用: {self.enable_plugin}, 防抖: {self.debounce_time}秒")
+        logger.info("[消息防抖动] 插件已加载 - 启用: %s, 防抖: %s秒", self.enable_plugin, self.debounce_time)
     
     def is_command(self, message: str) -> bool:
         """
@@ -59,14 +199,420 @@ class ContinuousMessagePlugin(Star):
         Returns:
             bool: 如果是指令返回True，否则返回False
         """
-        message = message.strip()
-        if not message:
-            return False
+        return self._is_command_stripped(message.lstrip())
+    
+    def _is_command_stripped(self, message: str) -> bool:
+        """
+        检查已去除首部空白的消息是否是指令（调用方已 strip 时使用，避免重复分配字符串）
+        
+        Args:
+            message: 已去除首部空白的消息内容
+            
+        Returns:
+            bool: 如果是指令返回True，否则返回False
+        """
+        # 前缀均为非空字符串，空消息不会匹配
+        return message.startswith(self._command_prefixes_tuple)
+    
+    def _extract_text_and_images(self, ev: AstrMessageEvent) -> Tuple[str, List[str], bool]:
+        """
+        从消息组件中提取完整文本（包含指令前缀）和图片 URL。
+        
+        event.message_str 可能已经去掉了前缀，所以优先使用原始组件，
+        无法提取文本时才退回到 message_str。
+        
+        Args:
+            ev: 消息事件
+            
+        Returns:
+            Tuple[str, List[str], bool]: (去除首尾空白的文本, 图片 URL 列表, 是否包含图片)
+        """
+        text_parts: List[str] = []
+        image_urls: List[str] = []
+        has_image = False
+        try:
+            for component in ev.message_obj.message:
+                comp_type = type(component)
+                # 文本组件（Plain）：提取原始文本
+                if comp_type in _TEXT_TYPES:
+                    try:
+                        text_parts.append(component.text)
+                    except AttributeError:
+                        pass
+                # 图片组件：记录 URL（URL 为空时退回到 file）
+                elif isinstance(component, _IMAGE_TYPES):
+                    has_image = True
+                    url = getattr(component, 'url', None) or getattr(component, 'file', None)
+                    if url:
+                        image_urls.append(url)
+        except Exception:
+            pass
+        
+        text = "".join(text_parts).strip() or (ev.message_str or "").strip()
+        return text, image_urls, has_image
+    
+    async def _fetch_history(self, conv_mgr, umo: str) -> Tuple[Optional[str], list]:
+        """
+        获取当前会话的对话 ID 与对话历史
+        
+        新会话还没有选中的对话时，由 get_conversation 创建，并返回新对话的 ID。
+        
+        Args:
+            conv_mgr: 对话管理器
+            umo: 会话标识（unified_msg_origin）
+            
+        Returns:
+            Tuple[Optional[str], list]: (对话 ID, 对话历史列表)，ID 未知时为 None
+        """
+        # 每轮都从存储读取，插件之外（面板、其他插件）对对话的修改不会被覆盖；
+        # 先等上一轮尚未完成的写回，避免读到旧历史后把上一轮覆盖掉
+        writes = self._pending_writes.get(umo)
+        if writes:
+            await asyncio.wait(set(writes), timeout=self._HISTORY_WRITE_TIMEOUT)
+        
+        curr_cid = await conv_mgr.get_curr_conversation_id(umo)
+        conversation = await conv_mgr.get_conversation(
+            umo,
+            curr_cid,
+            create_if_not_exists=True
+        )
+        
+        if conversation:
+            curr_cid = getattr(conversation, 'cid', None) or curr_cid
+        if conversation and conversation.history:
+            history = _json_loads(conversation.history)
+        else:
+            history = []
+        return curr_cid, history
+    
+    def _get_provider(self, umo: str):
+        """
+        获取会话当前使用的 LLM 提供商，_PROVIDER_CACHE_TTL 秒内复用上一次的结果
+        
+        写入缓存时顺带清理已过期的条目并限制在 _PROVIDER_CACHE_SIZE 个会话以内，
+        不长期持有可能已被重载或移除的提供商实例。
+        
+        Args:
+            umo: 会话标识（unified_msg_origin）
+            
+        Returns:
+            LLM 提供商，未找到时返回 None（None 不会被缓存）
+        """
+        now = time.monotonic()
+        cached = self._provider_cache.get(umo)
+        if cached is not None and now - cached[0] < self._PROVIDER_CACHE_TTL:
+            return cached[1]
+        
+        provider = self.context.get_using_provider(umo=umo)
+        cache = self._provider_cache
+        cache.pop(umo, None)
+        # 最早写入的条目在最前面：依次淘汰已过期或超出上限的
+        while cache:
+            oldest_ts = next(iter(cache.values()))[0]
+            if now - oldest_ts < self._PROVIDER_CACHE_TTL and len(cache) < self._PROVIDER_CACHE_SIZE:
+                break
+            cache.popitem(last=False)
+        if provider:
+            cache[umo] = (now, provider)
+        return provider
+    
+    async def _fetch_system_prompt(self, persona_mgr, umo: str) -> Optional[str]:
+        """
+        获取会话的系统提示词，_PERSONA_CACHE_TTL 秒内复用上一次的结果，
+        缓存超出 _PERSONA_CACHE_SIZE 个会话时淘汰最久未使用的
+        
+        Args:
+            persona_mgr: 人格管理器
+            umo: 会话标识（unified_msg_origin）
+            
+        Returns:
+            Optional[str]: 系统提示词，没有时返回 None
+        """
+        now = time.monotonic()
+        cached = self._persona_cache.get(umo)
+        if cached is not None and now - cached[0] < self._PERSONA_CACHE_TTL:
+            self._persona_cache.move_to_end(umo)
+            return cached[1]
+        
+        persona = await persona_mgr.get_default_persona_v3(umo=umo)
+        system_prompt = self._normalize_system_prompt(persona)
+        self._persona_cache[umo] = (now, system_prompt)
+        self._persona_cache.move_to_end(umo)
+        while len(self._persona_cache) > self._PERSONA_CACHE_SIZE:
+            self._persona_cache.popitem(last=False)
+        return system_prompt
+    
+    def _normalize_system_prompt(self, persona) -> Optional[str]:
+        """
+        从人格设定中取出系统提示词，并规范化为去除首尾空白的 str
+        
+        每轮发送的系统提示词保持逐字节一致，才能命中 LLM 服务端的前缀缓存。
+        
+        Args:
+            persona: get_default_persona_v3 的返回值（dict 或对象）
+            
+        Returns:
+            Optional[str]: 系统提示词，没有时返回 None
+        """
+        if not persona:
+            return None
+        if isinstance(persona, dict):
+            prompt = persona.get('prompt') or persona.get('system_prompt')
+        else:
+            prompt = getattr(persona, 'prompt', None) or getattr(persona, 'system_prompt', None)
+        if not prompt:
+            return None
+        return str(prompt).strip() or None
+    
+    def _history_window(self, history: list) -> list:
+        """
+        截取发送给 LLM 的对话历史，最多保留最近 max_history_turns 轮
+        
+        窗口起点每 history_cache_buffer 轮才向后移动一次：在这期间发送的历史前缀保持不变，
+        LLM 服务端的前缀缓存可以持续命中。存储中的完整历史不受影响。
+        
+        Args:
+            history: 完整的对话历史
+            
+        Returns:
+            list: 发送给 LLM 的历史（新列表）
+        """
+        max_turns = self.max_history_turns
+        turns = len(history) // 2
+        if max_turns <= 0 or turns <= max_turns:
+            return history[:]
+        
+        # 需要丢弃的轮数向上取整到 history_cache_buffer 的倍数
+        step = self.history_cache_buffer
+        drop_turns = -(-(turns - max_turns) // step) * step
+        start = min(drop_turns * 2, len(history))
+        # 从一条用户消息开始，避免窗口以 assistant / tool 消息开头
+        while start < len(history):
+            entry = history[start]
+            if isinstance(entry, dict) and entry.get('role') == 'user':
+                break
+            start += 1
+        return history[start:]
+    
+    async def _safe_update_conversation(self, conv_mgr, umo: str, curr_cid: Optional[str], history: list):
+        """
+        将对话历史写回存储（在后台任务中执行），失败时只记录日志
+        
+        Args:
+            conv_mgr: 对话管理器
+            umo: 会话标识（unified_msg_origin）
+            curr_cid: 对话 ID
+            history: 完整的对话历史
+        """
+        entry = self._history_locks.get(umo)
+        if entry is None:
+            entry = self._history_locks[umo] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await asyncio.wait_for(
+                    conv_mgr.update_conversation(
+                        umo,
+                        curr_cid,
+                        history=history
+                    ),
+                    self._HISTORY_WRITE_TIMEOUT,
+                )
+        except Exception as e:
+            logger.warning("[消息防抖动] 更新对话历史失败: %r", e)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._history_locks[umo]
+    
+    def _track_write(self, umo: str, task: asyncio.Task):
+        """
+        登记后台历史写回任务，任务结束后自动移除
+        
+        Args:
+            umo: 会话标识（unified_msg_origin）
+            task: 写回任务
+        """
+        tasks = self._pending_writes.get(umo)
+        if tasks is None:
+            tasks = self._pending_writes[umo] = set()
+        tasks.add(task)
+        task.add_done_callback(partial(self._forget_write, umo))
+    
+    def _forget_write(self, umo: str, task: asyncio.Task):
+        """写回任务结束时的回调：从登记中移除"""
+        tasks = self._pending_writes.get(umo)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._pending_writes[umo]
+    
+    async def terminate(self):
+        """插件被禁用或重载时，等待尚未完成的历史写回（最多 _TERMINATE_TIMEOUT 秒）"""
+        tasks = [task for tasks in self._pending_writes.values() for task in tasks]
+        if not tasks:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*tasks, return_exceptions=True),
+                self._TERMINATE_TIMEOUT,
+            )
+        except (TimeoutError, asyncio.TimeoutError):
+            remaining = sum(map(len, self._pending_writes.values()))
+            logger.warning("[消息防抖动] 等待对话历史写回超时，%d 个写回未完成", remaining)
+    
+    async def _wait_session_idle(self, umo: str, pending):
+        """
+        等待会话的防抖窗口或历史写回完成（最多 _COMMAND_WAIT_TIMEOUT 秒，不取消它们）
+        
+        Args:
+            umo: 会话标识（unified_msg_origin）
+            pending: 需要等待的窗口完成信号或写回任务
+        """
+        _, not_done = await asyncio.wait(set(pending), timeout=self._COMMAND_WAIT_TIMEOUT)
+        if not_done:
+            logger.warning("[消息防抖动] 等待会话 %s 之前的消息提交超时，继续处理", umo)
+    
+    async def _on_command(self, umo: str, window: Optional[_DebounceWindow]):
+        """
+        收到指令时的处理：结束进行中的防抖会话，等待该会话已收集的消息提交、历史写回完成，
+        再让该会话缓存的人格和提供商失效
+        
+        指令（如 /reset）可能修改对话历史，必须在插件写回之后执行，否则会被插件写回的旧历史覆盖。
+        
+        Args:
+            umo: 会话标识（unified_msg_origin）
+            window: 该会话进行中的防抖窗口，没有则为 None
+        """
+        if window is not None:
+            window.queue.put_nowait(None)
+        # 先等窗口提交完（提交时才登记写回任务），再等写回
+        unfinished = self._unfinished_windows.get(umo)
+        if unfinished:
+            await self._wait_session_idle(umo, unfinished)
+        writes = self._pending_writes.get(umo)
+        if writes:
+            await self._wait_session_idle(umo, writes)
+        self._persona_cache.pop(umo, None)
+        self._provider_cache.pop(umo, None)
+    
+    @staticmethod
+    def _merge_buffer(buffer: List[str], sep: str) -> str:
+        """
+        合并缓冲区中的消息
+        
+        每条消息入队前都已去除首尾空白，合并后无需再 strip；只有一条时直接返回，不做拷贝。
+        
+        Args:
+            buffer: 消息缓冲区
+            sep: 分隔符
+            
+        Returns:
+            str: 合并后的消息
+        """
+        if len(buffer) == 1:
+            return buffer[0]
+        return sep.join(buffer)
+    
+    def _acquire_window(self, umo: str) -> _DebounceWindow:
+        """
+        从复用池取出一个空的防抖窗口（池为空时新建），并登记为该会话进行中的窗口
+        
+        Args:
+            umo: 会话标识（unified_msg_origin）
             
-        for prefix in self.command_prefixes:
-            if message.startswith(prefix):
-                return True
-        return False
+        Returns:
+            _DebounceWindow: 防抖窗口
+        """
+        window = self._window_pool.pop() if self._window_pool else _DebounceWindow()
+        window.umo = umo
+        window.done = asyncio.get_running_loop().create_future()
+        self._active_windows[umo] = window
+        unfinished = self._unfinished_windows.get(umo)
+        if unfinished is None:
+            unfinished = self._unfinished_windows[umo] = set()
+        window.earlier = tuple(unfinished)
+        unfinished.add(window.done)
+        return window
+    
+    def _finish_window(self, window: _DebounceWindow):
+        """
+        标记防抖窗口已提交完毕，唤醒等待它的指令（可重复调用）
+        
+        Args:
+            window: _acquire_window 取出的窗口
+        """
+        done = window.done
+        if done.done():
+            return
+        done.set_result(None)
+        unfinished = self._unfinished_windows.get(window.umo)
+        if unfinished is not None:
+            unfinished.discard(done)
+            if not unfinished:
+                del self._unfinished_windows[window.umo]
+    
+    def _add_image_urls(self, window: _DebounceWindow, urls: List[str]):
+        """
+        将图片 URL 加入防抖窗口：按首次出现的顺序去重，最多保留 _MAX_IMAGES 张
+        
+        Args:
+            window: 防抖窗口
+            urls: 新消息中的图片 URL
+        """
+        image_urls = window.image_urls
+        seen_urls = window.seen_urls
+        for url in urls:
+            if len(image_urls) >= self._MAX_IMAGES:
+                break
+            if url not in seen_urls:
+                seen_urls.add(url)
+                image_urls.append(url)
+    
+    def _release_window(self, window: _DebounceWindow):
+        """
+        清空防抖窗口并放回复用池（超出容量时直接丢弃）
+        
+        Args:
+            window: _acquire_window 取出的窗口
+        """
+        window.buffer.clear()
+        window.image_urls.clear()
+        window.seen_urls.clear()
+        window.earlier = ()
+        window.count = 0
+        window.chars = 0
+        if len(self._window_pool) < self._WINDOW_POOL_SIZE:
+            self._window_pool.append(window)
+    
+    @staticmethod
+    def _request_key(umo: str, merged_msg: str, img_urls: List[str]) -> bytes:
+        """
+        计算请求摘要：对会话、合并消息和图片 URL 做 blake2b 摘要，
+        只保存 16 字节摘要，而不是整段合并消息
+        
+        Returns:
+            bytes: 请求摘要
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for part in (umo, merged_msg, *img_urls):
+            h.update(part.encode('utf-8', 'surrogatepass'))
+            h.update(b'\0')
+        return h.digest()
+    
+    def _settle_request(self, key: bytes, pending: asyncio.Future, response_text: Optional[str]):
+        """
+        请求结束：完成回复的 Future，唤醒等待中的相同请求，并移除登记
+        
+        Args:
+            key: 请求摘要
+            pending: 登记的 Future
+            response_text: LLM 回复，失败时为 None
+        """
+        if not pending.done():
+            pending.set_result(response_text)
+        if self._inflight_requests.get(key) is pending:
+            del self._inflight_requests[key]
     
     def _extract_response_text(self, response) -> str:
         """
@@ -78,13 +624,178 @@ class ContinuousMessagePlugin(Star):
         Returns:
             str: 提取的文本内容，如果无法提取则返回字符串表示
         """
-        possible_attrs = ['completion_text', 'result', 'content', 'text', 'message']
-        for attr in possible_attrs:
-            text = getattr(response, attr, None)
+        # 同一类型的响应已经确定过文本所在的属性，直接读取
+        resp_type = type(response)
+        known_attr = self._response_attr_by_type.get(resp_type)
+        if known_attr is not None:
+            text = getattr(response, known_attr, None)
             if text and isinstance(text, str):
                 return text
+        
+        # 普通实例属性直接从 __dict__ 读取，跳过描述符查找；
+        # 不在 __dict__ 中的（如 property）再回退到 getattr，保持原有优先级
+        attrs = getattr(response, '__dict__', None) or {}
+        for attr in _RESP_ATTRS:
+            text = attrs[attr] if attr in attrs else getattr(response, attr, None)
+            if text and isinstance(text, str):
+                self._response_attr_by_type[resp_type] = attr
+                return text
         return str(response)
     
+    async def _collect(self, window: _DebounceWindow) -> bool:
+        """
+        收集防抖窗口的后续消息，直到收到指令、防抖超时或缓冲区达到上限
+        
+        Args:
+            window: 本轮防抖窗口
+            
+        Returns:
+            bool: 被指令中断返回 True；防抖超时或缓冲区达到上限返回 False
+        """
+        loop = asyncio.get_running_loop()
+        queue = window.queue
+        buffer = window.buffer
+        # 每条消息都会用到的方法和配置预先绑定为局部变量
+        append_text = buffer.append
+        add_urls = self._add_image_urls
+        get_item = queue.get
+        max_messages = self.max_buffer_messages
+        max_chars = self.max_buffer_chars
+        chars = sum(map(len, buffer))
+        try:
+            # 整个窗口共用一个计时器，每收到新消息就推迟截止时间
+            async with _debounce_timeout(self.debounce_time) as debounce:
+                while len(buffer) < max_messages and chars < max_chars:
+                    item = await get_item()
+                    if item is None:
+                        # 指令中断
+                        return True
+                    text, item_urls = item
+                    append_text(text)
+                    chars += len(text)
+                    add_urls(window, item_urls)
+                    debounce.reschedule(loop.time() + self.debounce_time)
+            # 缓冲区达到上限：不再等待，提前提交，避免刷屏消息无限堆积
+            logger.info("[消息防抖动] 缓冲区达到上限（%d 条消息，%d 字符），提前提交", len(buffer), chars)
+            return False
+        except (TimeoutError, asyncio.TimeoutError):
+            return False
+        finally:
+            # 注销窗口，并收下计时结束时已入队但尚未取出的消息（它们已被 stop_event）
+            # 入队前已检查过上限（见 handle_private_msg），这些消息不会使缓冲区超出上限
+            if self._active_windows.get(window.umo) is window:
+                del self._active_windows[window.umo]
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    append_text(item[0])
+                    add_urls(window, item[1])
+    
+    async def _send_to_llm(
+        self,
+        merged_msg: str,
+        img_urls: List[str],
+        umo: str,
+        earlier: Tuple[asyncio.Future, ...] = (),
+    ) -> Optional[str]:
+        """
+        将合并的消息连同人格设定、对话历史一起发送给 LLM，并更新对话历史
+        
+        Args:
+            merged_msg: 合并后的消息
+            img_urls: 图片 URL 列表
+            umo: 会话标识（unified_msg_origin）
+            earlier: 同一会话中更早的、尚未提交完毕的防抖窗口（见 _DebounceWindow.earlier）
+            
+        Returns:
+            Optional[str]: LLM 回复，失败时返回 None
+        """
+        if not merged_msg:
+            return None
+        
+        # 获取 LLM 提供商
+        provider = self._get_provider(umo)
+        if not provider:
+            logger.warning("[消息防抖动] 未找到 LLM 提供商")
+            return None
+        
+        # 相同的请求仍在进行中（用户在收到回复前重发了同样的内容）：复用它的回复，不再请求 LLM
+        # 回复已经完成的，内容相同的新消息是新的一轮，照常请求
+        key = self._request_key(umo, merged_msg, img_urls)
+        pending = self._inflight_requests.get(key)
+        if pending is not None:
+            logger.info("[消息防抖动] 相同的请求正在进行，复用它的回复")
+            # 历史由发起请求的一方写入；shield 避免本次取消时连带取消共享的 Future
+            return await asyncio.shield(pending)
+        pending = asyncio.get_running_loop().create_future()
+        self._inflight_requests[key] = pending
+        
+        response_text = None
+        try:
+            # 同一会话的窗口按顺序提交：窗口已满时新消息会开启下一轮，两轮可能同时结束防抖，
+            # 后一轮要等前一轮登记历史写回后再读取历史，否则会覆盖掉前一轮
+            if earlier:
+                await self._wait_session_idle(umo, earlier)
+            
+            # 人格设定与对话历史互不依赖，并发获取
+            persona_mgr = self._persona_manager or self.context.persona_manager
+            conv_mgr = self._conv_mgr or self.context.conversation_manager
+            system_prompt, history_result = await asyncio.gather(
+                self._fetch_system_prompt(persona_mgr, umo),
+                self._fetch_history(conv_mgr, umo),
+                return_exceptions=True,
+            )
+            
+            # 获取人格设定
+            if isinstance(system_prompt, Exception):
+                logger.error("[消息防抖动] 获取会话人格失败: %r", system_prompt)
+                system_prompt = None
+            
+            # 获取对话历史（失败时不写回，避免用空历史覆盖原有记录）
+            history_ok = not isinstance(history_result, Exception)
+            if history_ok:
+                curr_cid, context_history = history_result
+            else:
+                logger.warning("[消息防抖动] 获取对话历史失败: %s", history_result)
+                curr_cid, context_history = None, []
+            
+            # 调用 LLM
+            response = await provider.text_chat(
+                prompt=merged_msg,
+                # 截取最近的若干轮
+                context=self._history_window(context_history),
+                system_prompt=system_prompt,
+                # 传入副本：窗口结束后 img_urls 会被清空复用
+                image_urls=img_urls[:] if img_urls else None
+            )
+            
+            # 获取响应文本
+            response_text = self._extract_response_text(response) or None
+            
+            if response_text is None:
+                logger.error("[消息防抖动] LLM 响应为空")
+            # 更新对话历史（获取历史失败时跳过）
+            elif history_ok:
+                # 写回存储放到后台，不阻塞回复（下一轮读取历史前会等待写回完成）
+                context_history += (
+                    {"role": "user", "content": merged_msg},
+                    {"role": "assistant", "content": response_text},
+                )
+                task = asyncio.create_task(
+                    self._safe_update_conversation(conv_mgr, umo, curr_cid, context_history)
+                )
+                self._track_write(umo, task)
+            
+        except Exception as e:
+            logger.error("[消息防抖动] LLM 请求失败: %r", e)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[消息防抖动] LLM 请求失败详情", exc_info=True)
+        
+        finally:
+            self._settle_request(key, pending, response_text)
+        
+        return response_text
+    
     @filter.event_message_type(filter.EventMessageType.PRIVATE_MESSAGE, priority=100)
     async def handle_private_msg(self, event: AstrMessageEvent):
         """
@@ -92,6 +803,7 @@ class ContinuousMessagePlugin(Star):
         
         - 如果是指令消息：直接放行，不干预
         - 否则，参与防抖聚合：
+          - 会话的第一条消息开启防抖窗口，后续消息通过窗口的队列交给它合并
           - debounce_time 秒内的新消息会被合并
           - 期间若出现指令，则结束本轮聚合
           - 超时后，把本轮聚合的文本一次性交给 LLM
@@ -100,308 +812,117 @@ class ContinuousMessagePlugin(Star):
         if not self.enable_plugin:
             return
         
-        # 从原始消息组件中提取完整文本（包含指令前缀）
-        # 因为 event.message_str 可能已经去掉了前缀
-        raw_text = ""
-        has_image = False
-        try:
-            for component in event.message_obj.message:
-                # 检查是否是文本组件（Plain）
-                if hasattr(component, 'text') or hasattr(component, '__class__'):
-                    comp_class_name = component.__class__.__name__
-                    if comp_class_name == 'Plain' or comp_class_name == 'Text':
-                        # 提取原始文本
-                        if hasattr(component, 'text'):
-                            raw_text += component.text
-                        elif hasattr(component, 'content'):
-                            raw_text += component.content
-                        elif hasattr(component, 'data'):
-                            raw_text += str(component.data)
-                
-                # 检查是否是图片组件
-                if self._ImageComponent is not None:
-                    is_image = isinstance(component, self._ImageComponent)
-                else:
-                    # 后备方案：使用类名检查
-                    is_image = (hasattr(component, '__class__') 
-                               and component.__class__.__name__ == 'Image')
-                
-                if is_image:
-                    has_image = True
-        except Exception:
-            pass
+        umo = event.unified_msg_origin
+        # 该会话是否已有进行中的防抖窗口（有则本条消息交给窗口的所有者处理）
+        window = self._active_windows.get(umo)
         
-        # 如果无法从组件提取文本，使用 event.message_str 作为后备
-        if not raw_text:
-            raw_text = (event.message_str or "").strip()
-        else:
-            raw_text = raw_text.strip()
+        # 快速路径：message_str 已经能判定为指令时，无需遍历消息组件
+        if self.is_command(event.message_str or ""):
+            # 指令直接放行
+            await self._on_command(umo, window)
+            return
+        
+        # 从原始消息组件中提取完整文本（包含指令前缀）和图片
+        raw_text, urls, has_image = self._extract_text_and_images(event)
         
         # 如果消息为空且没有图片，直接返回
         if not raw_text and not has_image:
             return
         
         # 检查是否是指令（使用原始文本，包含前缀）
-        if raw_text and self.is_command(raw_text):
+        if self._is_command_stripped(raw_text):
+            await self._on_command(umo, window)
             return
         
-        # 显示开始防抖处理的日志（优先显示文本，如果没有文本则显示图片标识）
-        display_msg = raw_text[:50] if raw_text else "[图片]"
-        logger.info(f"[消息防抖动] 开始防抖处理: {display_msg}")
+        # 缓冲区条目：优先使用文本，如果只有图片没有文本则使用占位符
+        entry = raw_text or "[图片]"
+        
+        # 已有的防抖窗口已满（所有者尚未取完队列）：本条消息开启新一轮防抖窗口
+        if window is not None and (
+            window.count >= self.max_buffer_messages or window.chars >= self.max_buffer_chars
+        ):
+            logger.info("[消息防抖动] 当前防抖窗口已满，新消息开启下一轮合并")
+            window = None
+        
+        # 已有防抖窗口：放入队列并接管这条消息，由窗口的所有者统一合并
+        if window is not None:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("[消息防抖动] 处理消息: %s", entry[:50])
+            event.stop_event()
+            window.count += 1
+            window.chars += len(entry)
+            window.queue.put_nowait((entry, urls))
+            return
+        
+        # 显示开始防抖处理的日志
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[消息防抖动] 开始防抖处理: %s", entry[:50])
         
         # 防抖时间 <= 0，不进行防抖
         if self.debounce_time <= 0:
             return
         
-        # 消息缓冲区
-        buffer: List[str] = []
+        # 普通消息或图片：接管处理，阻止后续默认流程
+        event.stop_event()
         
-        # 存储图片 URL 列表
-        image_urls = []
-        
-        # 处理第一条消息的函数（提取逻辑）
-        def process_message(ev: AstrMessageEvent) -> bool:
-            """处理单条消息，返回 True 表示成功处理，False 表示跳过"""
-            nonlocal buffer, image_urls
-            
-            # 从原始消息组件中提取完整文本（包含指令前缀）
-            text = ""
-            has_image = False
-            try:
-                for component in ev.message_obj.message:
-                    # 检查是否是文本组件（Plain）
-                    if hasattr(component, '__class__'):
-                        comp_class_name = component.__class__.__name__
-                        if comp_class_name == 'Plain' or comp_class_name == 'Text':
-                            # 提取原始文本
-                            if hasattr(component, 'text'):
-                                text += component.text
-                            elif hasattr(component, 'content'):
-                                text += component.content
-                            elif hasattr(component, 'data'):
-                                text += str(component.data)
-                    
-                    # 检查是否是图片组件
-                    if self._ImageComponent is not None:
-                        is_image = isinstance(component, self._ImageComponent)
-                    else:
-                        # 后备方案：使用类名检查
-                        is_image = (hasattr(component, '__class__') 
-                                   and component.__class__.__name__ == 'Image')
-                    
-                    if is_image:
-                        has_image = True
-                        if hasattr(component, 'url'):
-                            image_urls.append(component.url)
-                        elif hasattr(component, 'file'):
-                            image_urls.append(component.file)
-            except Exception:
-                pass
-            
-            # 如果无法从组件提取文本，使用 ev.message_str 作为后备
-            if not text:
-                text = (ev.message_str or "").strip()
-            else:
-                text = text.strip()
-            
-            # 如果既没有文本也没有图片，跳过
-            if not text and not has_image:
-                return False
-            
-            # 如果有文本，检查是否是指令
-            if text and self.is_command(text):
-                return False
-            
-            # 显示处理日志（优先显示文本，如果没有文本则显示图片标识）
-            display_msg = text[:50] if text else "[图片]"
-            logger.info(f"[消息防抖动] 处理消息: {display_msg}")
-            
-            # 普通消息或图片：接管处理，阻止后续默认流程
-            ev.stop_event()
-            
-            # 如果有文本，加入缓冲区
-            if text:
-                buffer.append(text)
-            
-            # 如果只有图片没有文本，添加占位符
-            if has_image and not text:
-                buffer.append("[图片]")
-            
-            return True
+        # 开启本轮防抖窗口（从复用池取出，结束后放回），后续消息由各自的事件处理器放入其队列
+        window = self._acquire_window(umo)
+        buffer = window.buffer
+        buffer.append(entry)
+        window.count = 1
+        window.chars = len(entry)
+        image_urls = window.image_urls
+        self._add_image_urls(window, urls)
         
-        # 先处理第一条消息
-        if not process_message(event):
-            # 如果第一条消息处理失败（是指令或空消息），直接返回
-            return
+        # 合并阶段用到的配置预先绑定为局部变量（umo 已在入口处取得）
+        sep = self.merge_separator
         
-        # 会话控制器：收集后续消息 + 超时判断
-        @session_waiter(timeout=self.debounce_time, record_history_chains=False)
-        async def collect_messages(
-            controller: SessionController,
-            ev: AstrMessageEvent,
-        ):
-            nonlocal buffer, image_urls
-            
-            # 从原始消息组件中提取完整文本（包含指令前缀）
-            text = ""
-            try:
-                for component in ev.message_obj.message:
-                    if hasattr(component, '__class__'):
-                        comp_class_name = component.__class__.__name__
-                        if comp_class_name == 'Plain' or comp_class_name == 'Text':
-                            if hasattr(component, 'text'):
-                                text += component.text
-                            elif hasattr(component, 'content'):
-                                text += component.content
-                            elif hasattr(component, 'data'):
-                                text += str(component.data)
-            except Exception:
-                pass
-            
-            # 如果无法从组件提取文本，使用 ev.message_str 作为后备
-            if not text:
-                text = (ev.message_str or "").strip()
-            else:
-                text = text.strip()
-            
-            # 检查是否是第一条消息的重复处理（避免 session_waiter 重复处理第一条消息）
-            # 如果 buffer 只有一条消息，且新消息内容与第一条相同，则跳过
-            if len(buffer) == 1 and text == buffer[0]:
-                logger.info(f"[消息防抖动] 跳过重复处理的第一条消息: {text[:50]}")
-                # 重置超时时间，继续等待后续消息
-                controller.keep(timeout=self.debounce_time, reset_timeout=True)
-                return
-            
-            # 处理后续消息
-            if not process_message(ev):
-                # 如果是指令，停止会话
-                if text and self.is_command(text):
-                    controller.stop()
-                return
-            
-            # 重置超时时间
-            controller.keep(timeout=self.debounce_time, reset_timeout=True)
-        
-        # 提取 LLM 调用逻辑为独立函数，供超时和指令中断时复用
-        async def send_to_llm(merged_msg: str, img_urls: List[str], umo: str):
-            """将合并的消息发送给 LLM 并返回响应"""
-            if not merged_msg:
-                return None
-            
-            # 获取 LLM 提供商
-            provider = self.context.get_using_provider(umo=umo)
-            if not provider:
-                logger.warning(f"[消息防抖动] 未找到 LLM 提供商")
-                return None
-            
-            # 获取人格设定
-            try:
-                persona = await self.context.persona_manager.get_default_persona_v3(umo=umo)
-                
-                if persona:
-                    if isinstance(persona, dict):
-                        system_prompt = persona.get('prompt') or persona.get('system_prompt')
-                    else:
-                        system_prompt = getattr(persona, 'prompt', None) or getattr(persona, 'system_prompt', None)
-                else:
-                    system_prompt = None
-                    
-            except Exception as e:
-                logger.error(f"[消息防抖动] 获取会话人格失败: {e}")
-                system_prompt = None
-            
-            # 获取对话历史
-            try:
-                conv_mgr = self.context.conversation_manager
-                curr_cid = await conv_mgr.get_curr_conversation_id(umo)
-                conversation = await conv_mgr.get_conversation(
-                    umo,
-                    curr_cid,
-                    create_if_not_exists=True
-                )
-                
-                if conversation and conversation.history:
-                    context_history = json.loads(conversation.history)
-                else:
-                    context_history = []
-            except Exception as e:
-                logger.warning(f"[消息防抖动] 获取对话历史失败: {e}")
-                context_history = []
-            
-            # 调用 LLM
-            try:
-                response = await provider.text_chat(
-                    prompt=merged_msg,
-                    context=context_history,
-                    system_prompt=system_prompt,
-                    image_urls=img_urls if img_urls else None
-                )
-                
-                # 获取响应文本
-                response_text = self._extract_response_text(response)
-                
-                if not response_text:
-                    logger.error(f"[消息防抖动] LLM 响应为空")
-                    return None
-                
-                # 更新对话历史
-                try:
-                    context_history.append({"role": "user", "content": merged_msg})
-                    context_history.append({"role": "assistant", "content": response_text})
-                    await conv_mgr.update_conversation(
-                        umo,
-                        curr_cid,
-                        history=context_history
-                    )
-                except Exception as e:
-                    logger.warning(f"[消息防抖动] 更新对话历史失败: {e}")
+        try:
+            # 等待后续消息
+            if await self._collect(window):
+                # 收到了指令，会话被提前结束
+                logger.info("[消息防抖动] 防抖会话被停止（可能是指令中断）")
                 
-                return response_text
+                # 如果有已收集的消息，先提交给 LLM
+                if buffer:
+                    merged_message = self._merge_buffer(buffer, sep)
+                    if merged_message:
+                        logger.info("[消息防抖动] 指令中断，提交已收集的 %d 条消息给 LLM", len(buffer))
+                        response_text = await self._send_to_llm(merged_message, image_urls, umo, window.earlier)
+                        # 历史写回已登记，可以让等待中的指令继续
+                        self._finish_window(window)
+                        if response_text:
+                            yield event.plain_result(response_text)
                 
-            except Exception as e:
-                logger.error(f"[消息防抖动] LLM 请求失败: {e}", exc_info=True)
-                return None
-        
-        try:
-            # 启动会话控制器，等待后续消息
-            await collect_messages(event)
-            # 如果正常返回（没有超时），说明被 controller.stop() 停止了（可能是指令中断）
-            logger.info(f"[消息防抖动] 防抖会话被停止（可能是指令中断）")
-            
-            # 如果有已收集的消息，先提交给 LLM
-            if buffer:
-                merged_message = self.merge_separator.join(buffer).strip()
-                if merged_message:
-                    logger.info(f"[消息防抖动] 指令中断，提交已收集的 {len(buffer)} 条消息给 LLM")
-                    umo = event.unified_msg_origin
-                    response_text = await send_to_llm(merged_message, image_urls, umo)
-                    if response_text:
-                        yield event.plain_result(response_text)
-            
-            # 让指令正常执行（不阻止事件传播）
-            return
+                # 让指令正常执行（不阻止事件传播）
+                return
             
-        except TimeoutError:
-            # 超时：合并并发送给 LLM
-            merged_message = self.merge_separator.join(buffer).strip()
+            # 防抖超时或缓冲区已满：合并并发送给 LLM
+            merged_message = self._merge_buffer(buffer, sep)
             if not merged_message:
                 return
 
-            logger.info(f"[消息防抖动] 防抖超时，合并了 {len(buffer)} 条消息，图片数: {len(image_urls)}")
+            logger.info("[消息防抖动] 防抖结束，合并了 %d 条消息，图片数: %d", len(buffer), len(image_urls))
             
             # 接管这轮消息
             event.stop_event()
             
             # 调用 LLM
-            umo = event.unified_msg_origin
-            response_text = await send_to_llm(merged_message, image_urls, umo)
+            response_text = await self._send_to_llm(merged_message, image_urls, umo, window.earlier)
             
             if response_text:
                 yield event.plain_result(response_text)
             else:
-                yield event.plain_result("抱歉，AI 没有返回有效响应。")
+                yield event.plain_result(_MSG_EMPTY_RESP)
         
         except Exception as e:
-            logger.error(f"[消息防抖动] 插件内部错误: {e}", exc_info=True)
+            logger.error("[消息防抖动] 插件内部错误: %r", e)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[消息防抖动] 插件内部错误详情", exc_info=True)
             event.stop_event()
-            yield event.plain_result(f"插件内部错误: {str(e)}")
+            yield event.plain_result(_MSG_INTERNAL_ERR + str(e))
+        
+        finally:
+            # LLM 调用已结束，窗口中的列表不再被引用，可以复用
+            self._finish_window(window)
+            self._release_window(window)